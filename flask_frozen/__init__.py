@@ -168,13 +168,20 @@ class Freezer:
         if remove_extra:
             # Remove files from the previous build that are not here anymore.
             ignore = self.app.config['FREEZER_DESTINATION_IGNORE']
-            previous_paths = set(
-                Path(self.root / name) for name in
-                walk_directory(self.root, ignore=ignore))
+            previous_paths = {
+                self.root / name
+                for name in walk_directory(self.root, ignore=ignore)}
+            extra_dirs = set()
             for extra_path in previous_paths - built_paths:
                 extra_path.unlink()
+                # Keep parent directories, but not the root itself
+                parents = extra_path.relative_to(self.root).parents
+                extra_dirs.update(list(parents)[:-1])
+            # Remove directories left empty, deepest first, each only once
+            for extra_dir in sorted(
+                    extra_dirs, key=lambda dir: len(dir.parts), reverse=True):
                 with suppress(OSError):
-                    extra_path.parent.rmdir()
+                    (self.root / extra_dir).rmdir()
 
     def freeze(self):
         """Clean the destination and build all URLs from generators."""
@@ -183,6 +190,7 @@ class Freezer:
     def all_urls(self):
         """Run all generators and yield URLs relative to the app root.
 
+        Each URL is only yielded once, even if several generators give it.
         May be useful for testing URL generators.
 
         .. note::
@@ -190,8 +198,11 @@ class Freezer:
             generated from :func:`flask.url_for` calls will not be included
             here.
         """
+        seen_urls = set()
         for url, _, _ in self._generate_all_urls():
-            yield url
+            if url not in seen_urls:
+                seen_urls.add(url)
+                yield url
 
     def _script_name(self):
         """Return the path part of FREEZER_BASE_URL, without trailing slash."""
@@ -334,7 +345,10 @@ class Freezer:
 
         # Write the file, but only if its content has changed
         content = response.data
-        previous_content = path.read_bytes() if path.is_file() else None
+        previous_content = None
+        if path.is_file() and path.stat().st_size == len(content):
+            # Files of a different size can not have the same content
+            previous_content = path.read_bytes()
         if content != previous_content:
             # Do not overwrite when content hasn't changed to help rsync
             # by keeping the modification date.
@@ -434,20 +448,27 @@ def walk_directory(root, ignore=()):
         others against individual slash-separated parts.
 
     """
+    # Patterns matching ignored directories, and everything they contain
+    patterns = [
+        full_pattern for pattern in ignore for full_pattern in (
+            pattern.rstrip('/'),
+            f'{pattern}*',
+            f'*/{pattern.rstrip("/")}',
+            f'*/{pattern}*',
+        )
+    ]
+
     for dir, dirs, filenames in os.walk(root):
         relative_dir = Path(dir).relative_to(root)
-        dir_path = str(relative_dir)
-
-        # Filter ignored directories
-        patterns = [
-            full_pattern for pattern in ignore for full_pattern in (
-                pattern.rstrip('/'),
-                f'{pattern}*',
-                f'*/{pattern.rstrip("/")}',
-                f'*/{pattern}*',
-            )
-        ]
-        if any(fnmatch(dir_path, pattern) for pattern in patterns):
+
+        # Filter ignored directories, pruning them so that they are not walked
+        dirs[:] = [
+            name for name in dirs if not any(
+                fnmatch(str(relative_dir / name), pattern)
+                for pattern in patterns)]
+        if not relative_dir.parts and any(
+                fnmatch(str(relative_dir), pattern) for pattern in patterns):
+            # Subdirectories are already filtered, only the root is left
             continue
 
         # Filter ignored filenames
@@ -6,12 +6,14 @@
     :license: BSD, see LICENSE for more details.
 """
 
-import sys
+import itertools
+import os
+import runpy
 import time
 import warnings
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from subprocess import STDOUT, check_output
 from unicodedata import normalize
 
 import flask_frozen
@@ -19,10 +21,12 @@ from flask import redirect
 from flask_frozen import (Freezer, FrozenFlaskWarning, MimetypeMismatchWarning,
                           MissingURLGeneratorWarning, NotFoundWarning,
                           RedirectWarning, walk_directory)
-from pytest import raises, warns
+from pytest import fixture, mark, raises, warns
 
 import test_app
 
+FAVICON = Path(test_app.FAVICON).read_bytes()
+
 
 def read_all(directory):
     return {
@@ -35,43 +39,57 @@ def normalize_set(set):
     return {normalize('NFC', name) for name in set}
 
 
+@contextmanager
+def warns_always(category):
+    # Record every warning, even if already emitted by a previous test
+    with warns(category) as logged_warnings:
+        warnings.simplefilter('always')
+        yield logged_warnings
+
+
+TEST_APP_PATHS = {
+    '__init__.py', 'static/favicon.ico', 'static/main.js',
+    'admin/__init__.py', 'admin/templates/admin.html'}
+
+
 def test_walk_directory():
     directory = Path(test_app.__file__).parent
-
-    paths = {
-        '__init__.py', 'static/favicon.ico', 'static/main.js',
-        'admin/__init__.py', 'admin/templates/admin.html'}
-    ignore_patterns = (
-        ('*.pyc', '*.pyo', '*.css'),
-        ('*.py?', '*/*/*.css', '*/*.css'),
-        ('*.py?', '*.css', '/templates'),
-        ('*.py?', '*.css', '/templates/*'),
-        ('*.py?', '*.css', 'templates/*'),
-        ('*.py?', '*.css', 'templates/admin.html'),
-        ('*.py?', '*.css', 'tem*es/*'),
-        ('*.py?', '*.css', '__init__.py/'),
-        ('*.py?', '*.css', '/__init__.py/'),
-    )
-    for ignore in ignore_patterns:
-        assert set(walk_directory(directory, ignore)) == paths
     assert {
         filename for filename in walk_directory(directory)
-        if not filename.endswith(('.pyc', '.pyo', '.css'))} == paths
-
-    paths = {path for path in paths if not path.startswith('admin/')}
-    ignore_patterns = (
-        ('*.py?', '*.css', '/admin'),
-        ('*.py?', '*.css', 'admin/'),
-        ('*.py?', '*.css', '/admin/'),
-        ('*.py?', '*.css', '/a*n/'),
-        ('*.py?', '*.css', 'admin/*'),
-        ('*.py?', '*.css', 'admin*'),
-        ('*.py?', '*.css', 'admin'),
-        ('*.py?', '*.css', 'admin/__init__.py', 'templates'),
-        ('*.py?', '*.css', 'admin/__init__.py', 'templates/'),
-    )
-    for ignore in ignore_patterns:
-        assert set(walk_directory(directory, ignore)) == paths
+        if not filename.endswith(('.pyc', '.pyo', '.css'))} == TEST_APP_PATHS
+
+
+@mark.parametrize('ignore', (
+    ('*.pyc', '*.pyo', '*.css'),
+    ('*.py?', '*/*/*.css', '*/*.css'),
+    ('*.py?', '*.css', '/templates'),
+    ('*.py?', '*.css', '/templates/*'),
+    ('*.py?', '*.css', 'templates/*'),
+    ('*.py?', '*.css', 'templates/admin.html'),
+    ('*.py?', '*.css', 'tem*es/*'),
+    ('*.py?', '*.css', '__init__.py/'),
+    ('*.py?', '*.css', '/__init__.py/'),
+))
+def test_walk_directory_ignore(ignore):
+    directory = Path(test_app.__file__).parent
+    assert set(walk_directory(directory, ignore)) == TEST_APP_PATHS
+
+
+@mark.parametrize('ignore', (
+    ('*.py?', '*.css', '/admin'),
+    ('*.py?', '*.css', 'admin/'),
+    ('*.py?', '*.css', '/admin/'),
+    ('*.py?', '*.css', '/a*n/'),
+    ('*.py?', '*.css', 'admin/*'),
+    ('*.py?', '*.css', 'admin*'),
+    ('*.py?', '*.css', 'admin'),
+    ('*.py?', '*.css', 'admin/__init__.py', 'templates'),
+    ('*.py?', '*.css', 'admin/__init__.py', 'templates/'),
+))
+def test_walk_directory_ignore_directory(ignore):
+    directory = Path(test_app.__file__).parent
+    paths = {path for path in TEST_APP_PATHS if not path.startswith('admin/')}
+    assert set(walk_directory(directory, ignore)) == paths
 
 
 def test_warnings_share_common_superclass():
@@ -93,11 +111,16 @@ def test_warnings_share_common_superclass():
 
 
 def test_importing_collections():
-    flask_script_path = flask_frozen.__file__
-    ps = check_output([sys.executable, flask_script_path], stderr=STDOUT)
-    stderr = ps.decode().lower()
-    assert 'deprecationwarning' not in stderr
-    assert 'using or importing the abcs' not in stderr
+    # Run the module code again in a fresh namespace, failing on deprecations
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', DeprecationWarning)
+        runpy.run_path(flask_frozen.__file__)
+
+
+@fixture(scope='class')
+def frozen_app(request, tmp_path_factory):
+    # Frozen once per test class, for tests that only read the build
+    return request.cls().freeze_app(tmp_path_factory.mktemp('build'))
 
 
 class TestFreezer:
@@ -111,14 +134,14 @@ class TestFreezer:
             b'<a href="/page/octothorp/?query_foo=bar#introduction">'
             b'URL parsing test</a>'),
         '/robots.txt': b'User-agent: *\nDisallow: /',
-        '/favicon.ico': Path(test_app.FAVICON).read_bytes(),
+        '/favicon.ico': FAVICON,
         '/product_0/': b'Product num 0',
         '/product_1/': b'Product num 1',
         '/product_2/': b'Product num 2',
         '/product_3/': b'Product num 3',
         '/product_4/': b'Product num 4',
         '/product_5/': b'Product num 5',
-        '/static/favicon.ico': Path(test_app.FAVICON).read_bytes(),
+        '/static/favicon.ico': FAVICON,
         '/static/style.css': b'/* Main CSS */',
         '/static/main.js': b'/* Main JS */',
         '/admin/css/style.css': b'/* Admin CSS */',
@@ -161,6 +184,11 @@ class TestFreezer:
     freezer_kwargs = None
     with_404 = False
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Overridden mappings must still cover the same URLs
+        assert set(cls.expected_output) == set(cls.filenames), cls.__name__
+
     def make_app(self, tmp_path, with_404=False):
         app, freezer = test_app.create_app(
             self.defer_init_app, self.freezer_kwargs)
@@ -185,25 +213,35 @@ class TestFreezer:
         with raises(Exception):
             freezer.freeze()
 
-    def test_all_urls_method(self, tmp_path):
-        app, freezer, urls = self.freeze_app(tmp_path)
-        expected = sorted(self.expected_output)
+    def test_all_urls_method(self, frozen_app):
+        app, freezer, urls = frozen_app
         # url_for() calls are not logged when just calling .all_urls()
-        for url in self.generated_by_url_for:
-            if url in expected:
-                expected.remove(url)
+        expected = sorted(
+            url for url in self.expected_output
+            if url not in self.generated_by_url_for)
         # Do not use set() here: also test that URLs are not duplicated.
         assert sorted(freezer.all_urls()) == expected
 
-    def test_built_urls(self, tmp_path):
-        app, freezer, urls = self.freeze_app(tmp_path)
+    def test_all_urls_once(self, tmp_path):
+        app, freezer = self.make_app(tmp_path)
+
+        @freezer.register_generator
+        def duplicated_urls():
+            # Same URL as ('product', {'product_id': 0}) from test_app
+            yield '/product_0/'
+
+        urls = list(freezer.all_urls())
+        assert urls.count('/product_0/') == 1
+
+    def test_built_urls(self, frozen_app):
+        app, freezer, urls = frozen_app
         assert set(urls) == set(self.expected_output)
         # Make sure it was not accidentally used as a destination
         default = Path(__file__).parent / 'build'
         assert not default.exists()
 
-    def test_contents(self, tmp_path):
-        app, freezer, urls = self.freeze_app(tmp_path)
+    def test_contents(self, frozen_app):
+        app, freezer, urls = frozen_app
         for url, filename in self.filenames.items():
             content = (freezer.root / filename).read_bytes()
             assert content == self.expected_output[url]
@@ -222,7 +260,7 @@ class TestFreezer:
         app, freezer, urls = self.freeze_app(tmp_path)
         app.config['FREEZER_REMOVE_EXTRA_FILES'] = remove_extra
         app.config['FREEZER_DESTINATION_IGNORE'] = ignore
-        dest = Path(app.config['FREEZER_DESTINATION'])
+        dest = freezer.root
         expected_files = normalize_set(set(self.filenames.values()))
 
         # No other files
@@ -243,19 +281,28 @@ class TestFreezer:
 
         assert normalize_set(walk_directory(dest)) == expected_files
 
-    def test_transitivity(self, tmp_path_factory):
-        tmp_path_1 = tmp_path_factory.mktemp('tmp1')
-        app, freezer, urls = self.freeze_app(tmp_path_1)
+    def test_remove_nested_extra_directories(self, tmp_path):
+        app, freezer, urls = self.freeze_app(tmp_path)
+        (freezer.root / 'extra' / 'nested').mkdir(parents=True)
+        (freezer.root / 'extra' / 'nested' / 'extra.txt').touch()
+        (freezer.root / 'static' / 'extra.txt').touch()
+
+        freezer.freeze()
+        assert not (freezer.root / 'extra').exists()
+        assert not (freezer.root / 'static' / 'extra.txt').exists()
+        assert (freezer.root / 'static').is_dir()
+
+    def test_transitivity(self, frozen_app, tmp_path):
+        app, freezer, urls = frozen_app
         destination = app.config['FREEZER_DESTINATION']
         # Run the freezer on its own output
-        tmp_path_2 = tmp_path_factory.mktemp('tmp2')
         app2 = freezer.make_static_app()
-        app2.config['FREEZER_DESTINATION'] = tmp_path_2
+        app2.config['FREEZER_DESTINATION'] = tmp_path
         app2.debug = True
         freezer2 = Freezer(app2)
         freezer2.register_generator(self.filenames.keys)
         freezer2.freeze()
-        assert read_all(destination) == read_all(tmp_path_2)
+        assert read_all(destination) == read_all(tmp_path)
 
     def test_error_on_external_url(self, tmp_path):
         urls = ('http://example.com/foo', '//example.com/foo', 'file:///foo')
@@ -266,31 +313,22 @@ class TestFreezer:
             def external_url():
                 yield url
 
-            try:
+            with raises(ValueError, match='External URLs not supported'):
                 freezer.freeze()
-            except ValueError as error:
-                assert 'External URLs not supported' in error.args[0]
-            else:
-                assert False, 'Expected ValueError'
 
     def test_error_on_internal_404(self, tmp_path):
         app, freezer = self.make_app(tmp_path, with_404=True)
         # Test standard behaviour with 404 errors (freeze failure)
-        try:
+        error_msg = "Unexpected status '404 NOT FOUND' on URL /404/"
+        with raises(ValueError, match=error_msg):
             freezer.freeze()
-        except ValueError as e:
-            error_msg = "Unexpected status '404 NOT FOUND' on URL /404/"
-            assert error_msg in e.args[0]
-        else:
-            assert False, 'Expected ValueError'
 
     def test_warn_on_internal_404(self, tmp_path):
         app, freezer = self.make_app(tmp_path, with_404=True)
         # Enable 404 errors ignoring
         app.config['FREEZER_IGNORE_404_NOT_FOUND'] = True
         # Test warning with 404 errors when we choose to ignore them
-        with warns(NotFoundWarning) as logged_warnings:
-            warnings.simplefilter('always')
+        with warns_always(NotFoundWarning) as logged_warnings:
             freezer.freeze()
         assert len(logged_warnings) == 1
 
@@ -298,21 +336,16 @@ class TestFreezer:
         app, freezer = self.make_app(tmp_path)
         # Enable errors on redirects.
         app.config['FREEZER_REDIRECT_POLICY'] = 'error'
-        try:
+        error_msg = "Unexpected status '302 FOUND' on URL /redirect/"
+        with raises(ValueError, match=error_msg):
             freezer.freeze()
-        except ValueError as e:
-            error_msg = "Unexpected status '302 FOUND' on URL /redirect/"
-            assert error_msg in e.args[0]
-        else:
-            assert False, 'Expected ValueError'
 
     def test_warn_on_redirect(self, tmp_path):
         app, freezer = self.make_app(tmp_path)
         # Enable ignoring redirects.
         app.config['FREEZER_REDIRECT_POLICY'] = 'ignore'
         # Test warning with 302 errors when we choose to ignore them
-        with warns(RedirectWarning) as logged_warnings:
-            warnings.simplefilter('always')
+        with warns_always(RedirectWarning) as logged_warnings:
             freezer.freeze()
         assert len(logged_warnings) == 1
 
@@ -324,8 +357,7 @@ class TestFreezer:
         def external_url(some_argument):
             return some_argument
 
-        with warns(MissingURLGeneratorWarning) as logged_warnings:
-            warnings.simplefilter('always')
+        with warns_always(MissingURLGeneratorWarning) as logged_warnings:
             freezer.freeze()
         assert len(logged_warnings) == 1
 
@@ -336,8 +368,7 @@ class TestFreezer:
         def no_extension():
             return '42', 200, {'Content-Type': 'image/png'}
 
-        with warns(MimetypeMismatchWarning) as logged_warnings:
-            warnings.simplefilter('always')
+        with warns_always(MimetypeMismatchWarning) as logged_warnings:
             freezer.freeze()
         assert len(logged_warnings) == 1
 
@@ -377,8 +408,7 @@ class TestFreezer:
         def no_extension():
             return '42', 200, {'Content-Type': 'application/octet-stream'}
 
-        with warns(MimetypeMismatchWarning) as logged_warnings:
-            warnings.simplefilter('always')
+        with warns_always(MimetypeMismatchWarning) as logged_warnings:
             freezer.freeze()
         assert len(logged_warnings) == 1
 
@@ -394,6 +424,21 @@ class TestFreezer:
         freezer.freeze()
         assert (tmp_path / 'skipped.html').read_text() == "6*9"
 
+    def test_only_write_changed_files(self, tmp_path):
+        app, freezer, urls = self.freeze_app(tmp_path)
+        unchanged = freezer.root / self.filenames['/robots.txt']
+        same_size = freezer.root / self.filenames['/']
+        other_size = freezer.root / self.filenames['/static/style.css']
+        os.utime(unchanged, (0, 0))
+        same_size.write_bytes(b'-' * len(self.expected_output['/']))
+        other_size.write_bytes(b'Outdated')
+
+        freezer.freeze()
+        assert unchanged.stat().st_mtime == 0
+        assert same_size.read_bytes() == self.expected_output['/']
+        assert other_size.read_bytes() == (
+            self.expected_output['/static/style.css'])
+
     def test_error_external_redirect(self, tmp_path):
         app, freezer = self.make_app(tmp_path)
         app.config['FREEZER_REDIRECT_POLICY'] = 'follow'
@@ -412,16 +457,17 @@ class TestInitApp(TestFreezer):
 
 
 class TestBaseURL(TestFreezer):
-    expected_output = TestFreezer.expected_output.copy()
-    expected_output['/'] = b'Main index /myapp/product_5/?revision=b12ef20'
-    expected_output['/where_am_i/'] = \
-        b'/myapp/where_am_i/ http://example/myapp/where_am_i/'
-    expected_output['/admin/'] = (
-        b'Admin index\n'
-        b'<a href="/myapp/page/I%20l%C3%B8v%C3%AB%20Unicode/">'
-        b'Unicode test</a>\n'
-        b'<a href="/myapp/page/octothorp/?query_foo=bar#introduction">'
-        b'URL parsing test</a>')
+    expected_output = {
+        **TestFreezer.expected_output,
+        '/': b'Main index /myapp/product_5/?revision=b12ef20',
+        '/where_am_i/': b'/myapp/where_am_i/ http://example/myapp/where_am_i/',
+        '/admin/': (
+            b'Admin index\n'
+            b'<a href="/myapp/page/I%20l%C3%B8v%C3%AB%20Unicode/">'
+            b'Unicode test</a>\n'
+            b'<a href="/myapp/page/octothorp/?query_foo=bar#introduction">'
+            b'URL parsing test</a>'),
+    }
 
     def do_extra_config(self, app, freezer):
         app.config['FREEZER_BASE_URL'] = 'http://example/myapp/'
@@ -439,31 +485,36 @@ class TestServerName(TestFreezer):
     def do_extra_config(self, app, freezer):
         app.config['SERVER_NAME'] = 'example.net'
 
-    expected_output = TestFreezer.expected_output.copy()
-    expected_output['/where_am_i/'] = (
-        b'/where_am_i/ http://example.net/where_am_i/')
+    expected_output = {
+        **TestFreezer.expected_output,
+        '/where_am_i/': b'/where_am_i/ http://example.net/where_am_i/',
+    }
 
 
 class TestWithoutUrlForLog(TestFreezer):
     freezer_kwargs = {'log_url_for': False}
-    expected_output = TestFreezer.expected_output.copy()
-    filenames = TestFreezer.filenames.copy()
-    for url in TestFreezer.generated_by_url_for:
-        del expected_output[url]
-        del filenames[url]
+    expected_output = {
+        url: content for url, content in TestFreezer.expected_output.items()
+        if url not in TestFreezer.generated_by_url_for}
+    filenames = {
+        url: filename for url, filename in TestFreezer.filenames.items()
+        if url not in TestFreezer.generated_by_url_for}
 
 
 class TestRelativeUrlFor(TestFreezer):
     def do_extra_config(self, app, freezer):
         app.config['FREEZER_RELATIVE_URLS'] = True
 
-    expected_output = TestFreezer.expected_output.copy()
-    expected_output['/admin/'] = (
-        b'Admin index\n'
-        b'<a href="../page/I%20l%C3%B8v%C3%AB%20Unicode/index.html">'
-        b'Unicode test</a>\n'
-        b'<a href="../page/octothorp/index.html?query_foo=bar#introduction">'
-        b'URL parsing test</a>')
+    expected_output = {
+        **TestFreezer.expected_output,
+        '/admin/': (
+            b'Admin index\n'
+            b'<a href="../page/I%20l%C3%B8v%C3%AB%20Unicode/index.html">'
+            b'Unicode test</a>\n'
+            b'<a href="../page/octothorp/index.html'
+            b'?query_foo=bar#introduction">'
+            b'URL parsing test</a>'),
+    }
 
 
 class TestRelativeUrlForPretty(TestFreezer):
@@ -471,23 +522,27 @@ class TestRelativeUrlForPretty(TestFreezer):
         app.config['FREEZER_RELATIVE_URLS'] = True
         app.config['FREEZER_RELATIVE_URLS_PRETTY'] = True
 
-    expected_output = TestFreezer.expected_output.copy()
-    expected_output['/admin/'] = (
-        b'Admin index\n'
-        b'<a href="../page/I%20l%C3%B8v%C3%AB%20Unicode/">'
-        b'Unicode test</a>\n'
-        b'<a href="../page/octothorp/?query_foo=bar#introduction">'
-        b'URL parsing test</a>')
+    expected_output = {
+        **TestFreezer.expected_output,
+        '/admin/': (
+            b'Admin index\n'
+            b'<a href="../page/I%20l%C3%B8v%C3%AB%20Unicode/">'
+            b'Unicode test</a>\n'
+            b'<a href="../page/octothorp/?query_foo=bar#introduction">'
+            b'URL parsing test</a>'),
+    }
 
 
 class TestStaticIgnore(TestFreezer):
     def do_extra_config(self, app, freezer):
         app.config['FREEZER_STATIC_IGNORE'] = ['*.js']
 
-    expected_output = TestFreezer.expected_output.copy()
-    filenames = TestFreezer.filenames.copy()
-    del expected_output['/static/main.js']
-    del filenames['/static/main.js']
+    expected_output = {
+        url: content for url, content in TestFreezer.expected_output.items()
+        if url != '/static/main.js'}
+    filenames = {
+        url: filename for url, filename in TestFreezer.filenames.items()
+        if url != '/static/main.js'}
 
 
 class TestLastModifiedGenerator(TestFreezer):
@@ -496,10 +551,12 @@ class TestLastModifiedGenerator(TestFreezer):
         # last_modified now. The first page should only be written on the first
         # run. The second page should be written on both runs.
         app, freezer = self.make_app(tmp_path)
+        builds = itertools.count()
 
         @app.route('/time/<when>/')
         def show_time(when):
-            return when + datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            # Content is different each time the page is built
+            return f'{when} {next(builds)}'
 
         @freezer.register_generator
         def view_post():
@@ -509,12 +566,14 @@ class TestLastModifiedGenerator(TestFreezer):
 
         freezer.freeze()
 
+        # Make the pages older than "now" instead of waiting
+        past = time.time() - 60
+        for key in ('epoch', 'now'):
+            os.utime(tmp_path / 'time' / key / 'index.html', (past, past))
         first_mtimes = {
             key: (tmp_path / 'time' / key / 'index.html').stat().st_mtime
             for key in ('epoch', 'now')}
 
-        time.sleep(2)
-
         freezer.freeze()
 
         second_mtimes = {